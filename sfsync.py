@@ -5,51 +5,234 @@ import shutil
 import time
 import argparse
 import sys
-import math
+import errno
+import ctypes
+import functools
+import multiprocessing
+import re
+import struct
 import colorama
 
 from colorama import Fore
+from stat import S_IMODE
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
-def _copyfileobj_patched(fsrc, fdst, length=0):
+COPY_BUFFER_SIZE = 2 ** 20          # buffer size of buffered file copy (when kernel side copy is not available)
+MAX_BATCH_SIZE = 64                 # max number of actions executed by one worker call
+MIN_PARALLEL_SUBFOLDERS = 4         # folder trees with less first-level subfolders are listed in one thread
+SMALL_FILE_SIZE = 64 * 1024         # smaller files are copied in batches per folder
+SUMMARY_MP_MIN_ROWS = 20000         # bigger summary tables are formatted by multiprocessing pool (fork only)
+SUMMARY_MP_CHUNK_SIZE = 1000        # number of summary rows formatted by one worker call
+
+SYNC_SIGNATURE_XATTR = "user.sfsync.sig"
+SYNC_SIGNATURE_FORMAT = struct.Struct("<qqQ")       # own mtime [ns], mtime of counterpart file [ns], file size
+
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "ceph", "glusterfs", "fuse.glusterfs", "lustre", "9p"}
+
+# statx() constants from linux/stat.h and linux/fcntl.h
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_MTIME = 0x40
+STATX_SIZE = 0x200
+
+
+def _fastcopy_copy_file_range(fsrc, fdst, file_size_B):
     """
-    Custom implementation of copyfileobj() method from shutil that uses custom buffer size.
-    Windows don't really like small buffers so we can gain speedup by using bigger buffer for bigger file (less overhead).
-    Python 3.8+ uses as default buffer size 1MB. But here we scale beyond 1MB as src file grows biggers.
+    Copies data with copy_file_range() (Linux only). On file systems with reflink support (btrfs, XFS) or server side
+    copy (NFSv4.2, SMB3) no data are transferred at all.
+    Returns False when copy_file_range cannot be used for given files (e.g. cross-device copy on older kernels)
+    and nothing was copied yet, so the caller can fall back to sendfile or buffered copy.
     """
-    file_size_B = os.fstat(fsrc.fileno()).st_size
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    blocksize = max(file_size_B, 2 ** 23)     # 8MB minimum, kernel caps single call anyway
+    copied = 0
+    while True:
+        try:
+            n_copied = os.copy_file_range(infd, outfd, blocksize)
+        except OSError as err:
+            if copied == 0 and err.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ETXTBSY, errno.EBADF):
+                return False
+            raise
+        if n_copied == 0:
+            # some kernel / file system combinations (cross-device on 5.3-5.18, procfs, some FUSE/CIFS) report nothing
+            # copied instead of an error, fall back unless the source file is really empty
+            if copied == 0 and file_size_B > 0:
+                return False
+            break
+        copied += n_copied
+    return True
+
+
+def _fastcopy_sendfile(fsrc, fdst, file_size_B):
+    """
+    Zero-copy data transfer done by the kernel (Linux only), bytes never visit user space.
+    Returns False when sendfile cannot be used for given files (e.g. procfs, some FUSE drives)
+    and nothing was copied yet, so the caller can fall back to the buffered copy.
+    """
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    blocksize = max(file_size_B, 2 ** 23)     # 8MB minimum, kernel caps single call anyway
+    offset = 0
+    while True:
+        try:
+            sent = os.sendfile(outfd, infd, offset, blocksize)
+        except OSError as err:
+            if offset == 0 and err.errno in (errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+
+    # sendfile does not move file position of input file, keep it consistent with the buffered copy
+    fsrc.seek(offset)
+    return True
+
+
+def _fastcopy_fcopyfile(fsrc, fdst):
+    """
+    Kernel copy of file data on macOS (same what Python 3.8+ shutil does on macOS).
+    """
+    import posix
+    try:
+        posix._fcopyfile(fsrc.fileno(), fdst.fileno(), posix._COPYFILE_DATA)
+    except OSError as err:
+        if err.errno in (errno.EINVAL, errno.ENOTSUP):
+            return False
+        raise
+    return True
+
+
+def _copyfile_windows(src, dst):
+    """
+    Copies file using Windows API CopyFileExW, which is the kernel optimized path used by Explorer as well.
+    File attributes and last modification time are preserved by the API itself.
+    """
+    if not _get_copyfileexw()(winapi_path(src), winapi_path(dst), None, None, None, 0):
+        raise ctypes.WinError(ctypes.get_last_error())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_copyfileexw():
+    """
+    Returns CopyFileExW() function from kernel32. Last error is captured right after the call (use_last_error),
+    so the reported error is not overwritten by anything the interpreter calls meanwhile.
+    """
+    from ctypes import wintypes
+    copyfileexw = ctypes.WinDLL("kernel32", use_last_error=True).CopyFileExW
+    copyfileexw.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPVOID, wintypes.LPVOID, wintypes.LPBOOL, wintypes.DWORD]
+    copyfileexw.restype = wintypes.BOOL
+    return copyfileexw
 
+
+def _copyfileobj(fsrc, fdst):
     """
-    Applied funtion:
-    1.0e+00 B -> 1024.0 kB
-    1.0e+01 B -> 1024.0 kB
-    1.0e+02 B -> 1024.0 kB
-    1.0e+03 B -> 1024.0 kB
-    1.0e+04 B -> 1024.0 kB
-    1.0e+05 B -> 1024.0 kB
-    1.0e+06 B -> 1024.0 kB   ... 1MB file has 1MB buffer
-    1.0e+07 B -> 3331.6 kB
-    1.0e+08 B -> 6733.2 kB
-    1.0e+09 B -> 10134.9 kB  ... 1GB file has 10MB buffer
-    1.0e+10 B -> 13536.5 kB
+    Copies file data between opened files on kernel side when possible (copy_file_range or sendfile on Linux,
+    fcopyfile on macOS), kernel picks the optimal transfer size on its own.
+    Otherwise (or when the kernel refuses to copy given files) data are copied by buffered copy with 1MB buffer,
+    the same way Python 3.8+ shutil does on Windows.
     """
-    buffer_size_kB = (math.log2(max(file_size_B, 1)) - 20) * 1024
-    buffer_size_kB = max(buffer_size_kB, 1024)
+    file_size_B = os.fstat(fsrc.fileno()).st_size
 
-    buffer_size_B = int(buffer_size_kB*1024)
-    if length > 0:
-        buffer_size_B = min(length, buffer_size_B)
+    # make sure nothing is pending in Python buffers before handing file descriptors to the kernel
+    fdst.flush()
+    if sys.platform.startswith("linux"):
+        if hasattr(os, "copy_file_range") and _fastcopy_copy_file_range(fsrc, fdst, file_size_B):
+            return
+        if _fastcopy_sendfile(fsrc, fdst, file_size_B):
+            return
+    if sys.platform == "darwin" and _fastcopy_fcopyfile(fsrc, fdst):
+        return
 
     # Localize variable access to minimize overhead.
-    fsrc_read = fsrc.read
+    fsrc_readinto = fsrc.readinto
     fdst_write = fdst.write
-    while True:
-        buf = fsrc_read(buffer_size_B)
-        if not buf:
-            break
-        fdst_write(buf)
+    with memoryview(bytearray(COPY_BUFFER_SIZE)) as mv:
+        while True:
+            n = fsrc_readinto(mv)
+            if not n:
+                break
+            elif n < COPY_BUFFER_SIZE:
+                with mv[:n] as smv:
+                    fdst_write(smv)
+            else:
+                fdst_write(mv)
+
+
+class _StatxTimestamp(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_int64), ("tv_nsec", ctypes.c_uint32), ("_reserved", ctypes.c_int32)]
+
+
+class _Statx(ctypes.Structure):
+    """
+    struct statx from linux/stat.h (fixed size of 256 bytes).
+    """
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32), ("stx_blksize", ctypes.c_uint32), ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32), ("stx_uid", ctypes.c_uint32), ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16), ("_spare0", ctypes.c_uint16), ("stx_ino", ctypes.c_uint64),
+        ("stx_size", ctypes.c_uint64), ("stx_blocks", ctypes.c_uint64), ("stx_attributes_mask", ctypes.c_uint64),
+        ("stx_atime", _StatxTimestamp), ("stx_btime", _StatxTimestamp), ("stx_ctime", _StatxTimestamp), ("stx_mtime", _StatxTimestamp),
+        ("_spare", ctypes.c_uint64 * 16)
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_libc_statx():
+    """
+    Returns statx() function from glibc (2.28+) or None when it is not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.POINTER(_Statx)]
+    statx.restype = ctypes.c_int
+    return statx
+
+
+def statx_size_mtime(path, flags=0):
+    """
+    Loads file size and last modification time (in ns) via statx(). Only these two fields are requested,
+    so network file systems (NFS, SMB, ...) do not need to fetch the rest of the attributes from the server.
+    With AT_STATX_DONT_SYNC flag the file system is allowed to answer from locally cached attributes instead of asking
+    the server at all. Returned values may then be stale (up to the attribute cache timeout of the mount, e.g. 'actimeo' for NFS).
+    """
+    buf = _Statx()
+    mask = STATX_SIZE | STATX_MTIME
+    if _get_libc_statx()(AT_FDCWD, os.fsencode(path), flags, mask, ctypes.byref(buf)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    if buf.stx_mask & mask != mask:
+        # file system did not provide requested fields
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    return buf.stx_size, buf.stx_mtime.tv_sec * 10 ** 9 + buf.stx_mtime.tv_nsec
+
+
+def is_network_mount(path):
+    """
+    Checks (Linux only) whether given path lives on network file system (NFS, SMB, ...) according to /proc/self/mounts.
+    Mounts nested inside the tree are not considered.
+    """
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+
+    path = os.path.join(os.path.realpath(path), "")
+    best_mountpoint, best_fstype = "", ""
+    for mountpoint, fstype in mounts:
+        mountpoint = mountpoint.replace("\\040", " ").replace("\\011", "\t")      # escaped white spaces
+        if path.startswith(os.path.join(mountpoint, "")) and len(mountpoint) > len(best_mountpoint):
+            best_mountpoint, best_fstype = mountpoint, fstype
+    return best_fstype in NETWORK_FS_TYPES or best_fstype.startswith("fuse.sshfs")
 
 
 class Action:
@@ -70,6 +253,8 @@ class PathType:
 
 
 class PathInfo:
+    __slots__ = ("pathtype", "abspath", "filesize", "modtime")     # no per-instance __dict__, there is one instance per file
+
     def __init__(self, pathtype, abspath, filesize=None, modtime=None):
         self.pathtype = pathtype
         self.abspath = abspath
@@ -89,33 +274,91 @@ def winapi_path(path):
     return path
 
 
-def list_folder_tree(filepath):
+def _scan_folder(prefix_len, statx_flags, root, file_list, subfolders):
     """
-    Method recursively lists all files from given root folder.
-    Optionally folder names from args.exclude_folder_names can be skipped.
-    Optionally file with file extensions args.exclude_file_ext can be skipped.
+    Lists one folder with os.scandir(). Files are appended to file_list as (relpath, PathInfo) with size and last
+    modification time (int ns), subfolders to be listed are appended to subfolders.
+    Size and time are taken from DirEntry.stat(), or from statx_size_mtime() with given flags when statx_flags is not None.
+    Relpath is sliced from the absolute path, prefix_len is length of the tree root path including trailing separator.
+    Returns False when folder could not be listed.
+    """
+    try:
+        scandir_it = os.scandir(root)
+    except OSError:
+        return False        # unreadable folder is skipped, same as os.walk() does
+
+    exclude_folder_names = args.exclude_folder_names
+    exclude_file_ext_re = args.exclude_file_ext_re
+    with scandir_it:
+        for entry in scandir_it:
+            # symlinks to folders are not followed (same as os.walk() does)
+            if entry.is_dir():
+                if not entry.is_symlink() and entry.name not in exclude_folder_names:
+                    subfolders.append(entry.path)
+            elif exclude_file_ext_re is None or not exclude_file_ext_re.search(entry.name):
+                path = entry.path
+                if statx_flags is not None:
+                    size, mt = statx_size_mtime(path, statx_flags)
+                else:
+                    stat = entry.stat()
+                    size, mt = stat.st_size, stat.st_mtime_ns
+                file_list.append((path[prefix_len:], PathInfo(PathType.FILE, path, filesize=size, modtime=mt)))
+    return True
+
+
+def _scan_folder_tree(prefix_len, statx_flags, filepath):
+    """
+    Recursively lists given folder tree. Returns list of folders and list of files as (relpath, PathInfo).
     """
     file_list = []
     folder_list = []
-    for root, folders, files in os.walk(filepath):
-        folders[:] = [dirname for dirname in folders if dirname not in args.exclude_folder_names]       # this will make os.walk to skip those folders
-        for ffile in files:
-            if not ffile.lower().endswith(args.exclude_file_ext):
-                path = os.path.abspath(os.path.join(root, ffile))
-                file_list.append(path)
-        folder_list.append(root)
-    print("Folder tree", filepath, "listed")
+    stack = [filepath]
+    while stack:
+        root = stack.pop()
+        if _scan_folder(prefix_len, statx_flags, root, file_list, stack):
+            folder_list.append((root[prefix_len:], PathInfo(PathType.FOLDER, root)))
     return folder_list, file_list
 
 
-def get_file_info(filepath):
+def list_folder_tree(filepath):
     """
-    Loads file site and last modification date for given filepath.
+    Method recursively lists all files from given root folder. Returns list of folders and list of files,
+    both as (relpath, PathInfo) where relpath is relative to given root folder.
+    os.scandir() is used so file types come directly from the directory listing and each file is stat-ed only once.
+    First-level subfolders are listed in parallel, since listing is bound by file system latency, not by CPU.
+    Optionally folder names from args.exclude_folder_names can be skipped.
+    Optionally file with file extensions args.exclude_file_ext can be skipped.
     """
-    size = os.path.getsize(filepath)
-    mt = os.path.getmtime(filepath)
+    file_list = []
+    folder_list = []
+    subfolders = []
+    # all listed paths start with the root path, so relpath is a plain slice (much cheaper than os.path.relpath)
+    prefix_len = len(os.path.join(filepath, ""))
+
+    # Narrow-mask statx() pays off on network file systems only, locally DirEntry.stat() is cheaper than the ctypes call.
+    if args.fast_stat:
+        statx_flags = AT_STATX_DONT_SYNC
+    elif args.use_statx and is_network_mount(filepath):
+        statx_flags = 0
+    else:
+        statx_flags = None
+
+    if _scan_folder(prefix_len, statx_flags, filepath, file_list, subfolders):
+        folder_list.append(("", PathInfo(PathType.FOLDER, filepath)))
 
-    return filepath, size, mt
+    scan_subtree = functools.partial(_scan_folder_tree, prefix_len, statx_flags)
+    if len(subfolders) < MIN_PARALLEL_SUBFOLDERS:
+        subtrees = map(scan_subtree, subfolders)
+    else:
+        with ThreadPoolExecutor(min(32, (os.cpu_count() or 1) * 4)) as pool:
+            subtrees = list(pool.map(scan_subtree, subfolders))
+
+    for sub_folder_list, sub_file_list in subtrees:
+        folder_list.extend(sub_folder_list)
+        file_list.extend(sub_file_list)
+
+    print("Folder tree", filepath, "listed")
+    return folder_list, file_list
 
 
 def merge_trees(source_tree, target_tree, source_folders, target_folders):
@@ -124,24 +367,16 @@ def merge_trees(source_tree, target_tree, source_folders, target_folders):
     where key is the relpath to the file (rel to source/target root).
     """
     index = {}
-    for path, size, mt in source_tree:
-        relpath = os.path.relpath(path, args.source)
-        source_info = PathInfo(PathType.FILE, path, filesize=size, modtime=mt)
+    for relpath, source_info in source_tree:
         index[relpath] = (source_info, None)
-    for path in source_folders:
-        relpath = os.path.relpath(path, args.source)
-        source_info = PathInfo(PathType.FOLDER, path)
+    for relpath, source_info in source_folders:
         index[relpath] = (source_info, None)
 
-    for path, size, mt in target_tree:
-        relpath = os.path.relpath(path, args.target)
+    for relpath, target_info in target_tree:
         source_info, _ = index.get(relpath, (None, None))
-        target_info = PathInfo(PathType.FILE, path, filesize=size, modtime=mt)
         index[relpath] = (source_info, target_info)
-    for path in target_folders:
-        relpath = os.path.relpath(path, args.target)
+    for relpath, target_info in target_folders:
         source_info, _ = index.get(relpath, (None, None))
-        target_info = PathInfo(PathType.FOLDER, path)
         index[relpath] = (source_info, target_info)
 
     return index
@@ -151,95 +386,145 @@ def get_sync_direction(index):
     """
     Based on source and target file properties (does it exists?, their last modification time and size) and input args the method decides
     sync direction. I.e. whether to copy file from source to target or from target to source - or whether to remove target file.
+    Returns dict where key is the action and value is list of (relpath, source_info, target_info) to apply the action on.
     """
-    what_to_do_index = {}
+    what_to_do = {Action.REMOVE_TARGET: [], Action.COPY_SOURCE_TO_TARGET: [], Action.COPY_TARGET_TO_SOURCE: []}
+    removes = what_to_do[Action.REMOVE_TARGET]
+    copies_s2t = what_to_do[Action.COPY_SOURCE_TO_TARGET]
+    copies_t2s = what_to_do[Action.COPY_TARGET_TO_SOURCE]
+
+    # Flags are constant for the whole run, so decide once where each case goes instead of checking them for each file.
+    # Files only on target are copied to source, removed from target or (None) left alone.
+    if not args.one_direction_sync:
+        target_only = copies_t2s
+    elif args.delete_orphans:
+        target_only = removes
+    else:
+        target_only = None
+    # files with older source are overwritten either on source or on target
+    source_older = copies_t2s if not args.prefer_source else copies_s2t
+    source_root = args.source
+    target_root = args.target
+    path_join = os.path.join
+    FILE = PathType.FILE
 
     for relpath, (source_info, target_info) in index.items():
 
         # source file does not exist
         if source_info is None:
-            source_info = PathInfo(target_info.pathtype, os.path.join(args.source, relpath))
-            if not args.one_direction_sync:
-                what_to_do_index[relpath] = (Action.COPY_TARGET_TO_SOURCE, source_info, target_info)
-            elif args.delete_orphans:
-                what_to_do_index[relpath] = (Action.REMOVE_TARGET, source_info, target_info)
-            else:
-                continue
+            if target_only is not None:
+                target_only.append((relpath, PathInfo(target_info.pathtype, path_join(source_root, relpath)), target_info))
 
         # target file does not exist
         elif target_info is None:
-            target_info = PathInfo(source_info.pathtype, os.path.join(args.target, relpath))
-            what_to_do_index[relpath] = (Action.COPY_SOURCE_TO_TARGET, source_info, target_info)
+            target_info = PathInfo(source_info.pathtype, path_join(target_root, relpath))
+            copies_s2t.append((relpath, source_info, target_info))
 
         # both files exist, do a sync
-        elif (source_info.pathtype == PathType.FILE) and (target_info.pathtype == PathType.FILE):
+        elif source_info.pathtype == FILE and target_info.pathtype == FILE:
+            source_mt = source_info.modtime
+            target_mt = target_info.modtime
+
             # files are the same
-            if (source_info.modtime == target_info.modtime) and (source_info.filesize == target_info.filesize):
+            if source_mt == target_mt and source_info.filesize == target_info.filesize:
                 continue
 
             # source is older
-            elif source_info.modtime < target_info.modtime:
-                what_to_do_index[relpath] = (Action.COPY_TARGET_TO_SOURCE if not args.prefer_source else Action.COPY_SOURCE_TO_TARGET, source_info, target_info)
+            elif source_mt < target_mt:
+                source_older.append((relpath, source_info, target_info))
 
             # target is older
-            elif source_info.modtime > target_info.modtime:
-                what_to_do_index[relpath] = (Action.COPY_SOURCE_TO_TARGET, source_info, target_info)
+            elif source_mt > target_mt:
+                copies_s2t.append((relpath, source_info, target_info))
 
             else:
                 raise Exception(F"File {relpath} have same createdTime, but different file size: {source_info.filesize} != {target_info.filesize}! One of them might be corrupted!")
 
-    return what_to_do_index
+    return what_to_do
 
 
-def print_summary(index):
+def _sizeof_fmt(num, suffix='B'):
     """
-    Prints summary table in format:
-    Sync direction, Last modification data, File sizes, Relative path
+    Converts byte site to human readable file size.
     """
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "%7.3f%-3s" % (num, unit+suffix)
+        num /= 1024.0
+    return "%.1f%-3s" % (num, 'Yi'+suffix)
 
-    def sizeof_fmt(num, suffix='B'):
-        """
-        Converts byte site to human readable file size.
-        """
-        for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-            if abs(num) < 1024.0:
-                return "%7.3f%-3s" % (num, unit+suffix)
-            num /= 1024.0
-        return "%.1f%-3s" % (num, 'Yi'+suffix)
 
-    print()
-    print(Fore.GREEN + "SOURCE:" + Fore.RESET, args.source)
-    print(Fore.YELLOW + "TARGET:" + Fore.RESET, args.target)
-    print()
+@functools.lru_cache(maxsize=4096)
+def _time_fmt(mtime_s):
+    """
+    Formats last modification time (in seconds). Cached, since lots of files usually share the same time.
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime_s))
 
-    print('{:17}'.format('Sync direction') + " | " + '{:41}'.format('Last modification time') + " | " + '{:23}'.format('File size') + " | Relative path:")
-    print("-"*200)
 
-    for relpath, (direction, source_info, target_info) in index.items():
-        source_time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(source_info.modtime)) if source_info.modtime is not None else "xxxx-xx-xx 00:00:00"
-        target_time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(target_info.modtime)) if target_info.modtime is not None else "xxxx-xx-xx 00:00:00"
+def _format_summary_rows(rows):
+    """
+    Formats summary table rows given as flat tuples (direction, relpath, source_mt, source_size, target_mt, target_size)
+    into one string. Runs in worker processes for big summaries, so it must not depend on global args
+    and rows are plain tuples (cheap to pickle, unlike PathInfo objects).
+    """
+    lines = []
+    for direction, relpath, source_mt, source_size, target_mt, target_size in rows:
+        source_time_str = _time_fmt(source_mt // 10 ** 9) if source_mt is not None else "xxxx-xx-xx 00:00:00"
+        target_time_str = _time_fmt(target_mt // 10 ** 9) if target_mt is not None else "xxxx-xx-xx 00:00:00"
 
         direction_str = Action.labels[direction]
 
         # figure out time operator
-        if source_info.modtime is None or target_info.modtime is None:
+        if source_mt is None or target_mt is None:
             time_op = "?"
-        elif source_info.modtime > target_info.modtime:
+        elif source_mt > target_mt:
             time_op = ">"
         else:
             time_op = "<"
 
         # figure out size operator
-        source_info.filesize = source_info.filesize if source_info.filesize is not None else 0.0
-        target_info.filesize = target_info.filesize if target_info.filesize is not None else 0.0
-        if source_info.filesize > target_info.filesize:
+        source_size = source_size if source_size is not None else 0.0
+        target_size = target_size if target_size is not None else 0.0
+        if source_size > target_size:
             size_op = ">"
-        elif source_info.filesize == target_info.filesize:
+        elif source_size == target_size:
             size_op = "="
         else:
             size_op = "<"
 
-        print(F"{direction_str:27s} | {source_time_str} {time_op} {target_time_str} | {sizeof_fmt(source_info.filesize)} {size_op} {sizeof_fmt(target_info.filesize)} | {relpath}")
+        lines.append(F"{direction_str:27s} | {source_time_str} {time_op} {target_time_str} | {_sizeof_fmt(source_size)} {size_op} {_sizeof_fmt(target_size)} | {relpath}\n")
+    return "".join(lines)
+
+
+def print_summary(what_to_do):
+    """
+    Prints summary table in format:
+    Sync direction, Last modification data, File sizes, Relative path
+    Big tables are formatted in parallel by forked worker processes (formatting is pure Python, i.e. bound by GIL).
+    """
+    print()
+    print(Fore.GREEN + "SOURCE:" + Fore.RESET, args.source)
+    print(Fore.YELLOW + "TARGET:" + Fore.RESET, args.target)
+    print()
+
+    print('{:17}'.format('Sync direction') + " | " + '{:41}'.format('Last modification time') + " | " + '{:23}'.format('File size') + " | Relative path:")
+    print("-"*200)
+
+    rows = [(direction, relpath, source_info.modtime, source_info.filesize, target_info.modtime, target_info.filesize)
+            for direction, tasks in what_to_do.items() for relpath, source_info, target_info in tasks]
+
+    # rows are written in big chunks, print() per row is slow for big summaries
+    # (single write() per chunk, colorama's stdout wrapper on Windows translates colors in write() only)
+    # Pool pays off with fork start method only, spawning fresh interpreters (Windows, macOS) is slower than formatting.
+    if len(rows) < SUMMARY_MP_MIN_ROWS or (os.cpu_count() or 1) == 1 or multiprocessing.get_start_method() != "fork":
+        sys.stdout.write(_format_summary_rows(rows))
+    else:
+        chunks = [rows[i:i + SUMMARY_MP_CHUNK_SIZE] for i in range(0, len(rows), SUMMARY_MP_CHUNK_SIZE)]
+        with multiprocessing.Pool() as pool:
+            for text in pool.imap(_format_summary_rows, chunks):
+                sys.stdout.write(text)
+    sys.stdout.flush()
     print()
 
 
@@ -264,59 +549,207 @@ def make_dir(folderpath):
         print(F"DryRun: makedir {folderpath}")
 
 
-def copy_file(src, dst):
-    if not args.dry_run:
-        dirpath = os.path.dirname(dst)
-        if not os.path.isdir(dirpath):
-            os.makedirs(dirpath, exist_ok=True)
+def _copy_metadata(fsrc, fdst, signature_on_dst=False, signature_on_src=False):
+    """
+    Copies permission bits and access/modification times (ns precision) between opened files.
+    Unlike shutil.copystat() extended attributes, ACLs and file flags are not copied, only the times matter for the sync.
+    When the time got rounded by destination file system, sync signature is stored on the destination file
+    (signature_on_dst, its file system supports xattrs), or else on the source file (signature_on_src), e.g. when
+    copying from ext4 to FAT/exFAT.
+    """
+    fdst.flush()
+    stat = os.fstat(fsrc.fileno())
+    outfd = fdst.fileno()
+    os.chmod(outfd, S_IMODE(stat.st_mode))
+    os.utime(outfd, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    # file system with coarse time resolution (FAT, some SMB/NFS servers) rounds the time, remember the pair is synced
+    if signature_on_dst or signature_on_src:
+        dst_mt = os.fstat(outfd).st_mtime_ns
+        if dst_mt != stat.st_mtime_ns:
+            if signature_on_dst:
+                set_sync_signature(outfd, dst_mt, stat.st_mtime_ns, stat.st_size)
+            else:
+                set_sync_signature(fsrc.fileno(), stat.st_mtime_ns, dst_mt, stat.st_size)
+
+
+def set_sync_signature(path, own_mt, other_mt, size):
+    """
+    Stores sync signature (own mtime, mtime of the counterpart file, file size) as extended attribute of the file.
+    Silently does nothing when file system does not support extended attributes.
+    """
+    try:
+        os.setxattr(path, SYNC_SIGNATURE_XATTR, SYNC_SIGNATURE_FORMAT.pack(own_mt, other_mt, size))
+    except OSError:
+        pass
+
+
+def supports_sync_signature(path):
+    """
+    Checks whether file system of given folder supports extended attributes, i.e. whether sync signatures can be stored.
+    """
+    if not hasattr(os, "getxattr"):
+        return False
+    try:
+        os.getxattr(path, SYNC_SIGNATURE_XATTR)
+    except OSError as err:
+        return err.errno == errno.ENODATA       # attribute is just missing
+    return True
+
+
+def has_sync_signature(path, own_mt, other_mt, size):
+    """
+    Checks whether the file carries sync signature matching given mtimes and size,
+    i.e. the file was synced with its counterpart and none of them changed since then.
+    """
+    try:
+        signature = os.getxattr(path, SYNC_SIGNATURE_XATTR)
+    except OSError:
+        return False
+    return signature == SYNC_SIGNATURE_FORMAT.pack(own_mt, other_mt, size)
+
+
+def drop_synced_pairs(index):
+    """
+    Removes file pairs from the index which differ in last modification time only because the time got rounded when
+    the file was copied by previous sync (see set_sync_signature()). Only pairs with same size and different mtime are
+    checked, so unchanged trees cost no extra syscalls.
+    """
+    synced = []
+    for relpath, (source_info, target_info) in index.items():
+        if (source_info is None) or (target_info is None) or (source_info.pathtype != PathType.FILE) or (target_info.pathtype != PathType.FILE):
+            continue
+        if source_info.modtime != target_info.modtime and source_info.filesize == target_info.filesize:
+            if (args.signature_on_target and has_sync_signature(target_info.abspath, target_info.modtime, source_info.modtime, target_info.filesize)) or \
+                    (args.signature_on_source and has_sync_signature(source_info.abspath, source_info.modtime, target_info.modtime, source_info.filesize)):
+                synced.append(relpath)
+
+    for relpath in synced:
+        del index[relpath]
+
 
-        shutil.copy2(src, dst)
+def copy_file(src, dst, signature_on_dst=False, signature_on_src=False):
+    """
+    Copies file data, permission bits and last modification time. Destination folder is expected to exist already.
+    """
+    if not args.dry_run:
+        if os.name == "nt":
+            _copyfile_windows(src, dst)
+        else:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                _copyfileobj(fsrc, fdst)
+                _copy_metadata(fsrc, fdst, signature_on_dst, signature_on_src)
     else:
         print(F"DryRun: copy {src} \n\t\t---> {dst}")
 
 
-def execute_file_action(action: Action, source_info: PathInfo, target_info: PathInfo):
-    if action == Action.REMOVE_TARGET:
-        remove_file(target_info.abspath)
-    elif action == Action.COPY_SOURCE_TO_TARGET:
-        copy_file(source_info.abspath, target_info.abspath)
-    elif action == Action.COPY_TARGET_TO_SOURCE:
-        copy_file(target_info.abspath, source_info.abspath)
-    else:
-        raise Exception(F"Unsupported action ID: {action}")
+def remove_target(task):
+    _, source_info, target_info = task
+    remove_file(target_info.abspath)
 
 
-def execute_folder_action(action, source_info, target_info):
-    if action == Action.REMOVE_TARGET:
-        remove_dir(target_info.abspath)
-    elif action == Action.COPY_SOURCE_TO_TARGET:
-        make_dir(target_info.abspath)
-    elif action == Action.COPY_TARGET_TO_SOURCE:
-        make_dir(source_info.abspath)
-    else:
-        raise Exception(F"Unsupported action ID: {action}")
+def copy_source_to_target(task):
+    _, source_info, target_info = task
+    copy_file(source_info.abspath, target_info.abspath, args.signature_on_target, args.signature_on_source)
 
 
-def execute_action(data):
-    action, source_info, target_info = data
-    if source_info.pathtype == PathType.FILE:
-        execute_file_action(action, source_info, target_info)
-    else:
-        execute_folder_action(action, source_info, target_info)
+def copy_target_to_source(task):
+    _, source_info, target_info = task
+    copy_file(target_info.abspath, source_info.abspath, args.signature_on_source, args.signature_on_target)
+
+
+def _open_at(dir_fd, name, flags):
+    return os.open(name, flags, 0o666, dir_fd=dir_fd)
+
+
+def copy_small_files(src_dir, dst_dir, names, signature_on_dst=False, signature_on_src=False):
+    """
+    Copies several small files from one folder to another. Both folders are opened once and files are opened relative
+    to them (openat), so the kernel does not resolve the whole path for each file. Takes list of (src_name, dst_name).
+    """
+    src_dir_fd = os.open(src_dir, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        dst_dir_fd = os.open(dst_dir, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        try:
+            src_opener = functools.partial(_open_at, src_dir_fd)
+            dst_opener = functools.partial(_open_at, dst_dir_fd)
+            errors = []
+            for src_name, dst_name in names:
+                # failing file does not stop the rest of the files, the first error is raised at the end
+                try:
+                    with open(src_name, "rb", opener=src_opener) as fsrc, open(dst_name, "wb", opener=dst_opener) as fdst:
+                        _copyfileobj(fsrc, fdst)
+                        _copy_metadata(fsrc, fdst, signature_on_dst, signature_on_src)
+                except Exception as err:
+                    errors.append(err)
+        finally:
+            os.close(dst_dir_fd)
+    finally:
+        os.close(src_dir_fd)
+
+    if errors:
+        raise errors[0]
     return True
 
 
+def split_small_copies(tasks, source_to_target):
+    """
+    Splits copy tasks to small files (grouped by source and destination folder) and the rest.
+    Returns dict {(src_dir, dst_dir): [(src_name, dst_name), ...]} and list of remaining tasks.
+    """
+    groups = {}
+    rest = []
+    for task in tasks:
+        _, source_info, target_info = task
+        src_info, dst_info = (source_info, target_info) if source_to_target else (target_info, source_info)
+        if src_info.filesize < SMALL_FILE_SIZE:
+            src_dir, src_name = os.path.split(src_info.abspath)
+            dst_dir, dst_name = os.path.split(dst_info.abspath)
+            groups.setdefault((src_dir, dst_dir), []).append((src_name, dst_name))
+        else:
+            rest.append(task)
+    return groups, rest
+
+
+def execute_batch(func, batch):
+    """
+    Executes func on several tasks in one worker call. Trees with thousands of small files are bound by per-task overhead
+    (submit, future, thread wake-up) rather than by bytes moved, so tasks are handed to the workers in batches.
+    Failing task does not stop the rest of the batch, the first error is raised once the whole batch is done.
+    """
+    errors = []
+    for task in batch:
+        try:
+            func(task)
+        except Exception as err:
+            errors.append(err)
+    if errors:
+        raise errors[0]
+    return True
+
+
+def split_by_pathtype(tasks):
+    """
+    Splits list of (relpath, source_info, target_info) tasks to file tasks and folder tasks.
+    """
+    files = []
+    folders = []
+    for task in tasks:
+        (files if task[1].pathtype == PathType.FILE else folders).append(task)
+    return files, folders
+
+
 def main():
     with ThreadPoolExecutor(2) as pool:
         (source_folders, source_files), (target_folders, target_files) = list(pool.map(list_folder_tree, [args.source, args.target]))
 
-    with ThreadPoolExecutor() as pool:
-        source_files_info = list(pool.map(get_file_info, source_files))
-        print("Source files info retrieved")
-        target_files_info = list(pool.map(get_file_info, target_files))
-        print("Target files info retrieved")
+    index = merge_trees(source_files, target_files, source_folders, target_folders)
 
-    index = merge_trees(source_files_info, target_files_info, source_folders, target_folders)
+    # sync signatures are checked / stored only where the file system supports xattrs (not on FAT/exFAT, Windows, macOS)
+    args.signature_on_source = supports_sync_signature(args.source)
+    args.signature_on_target = supports_sync_signature(args.target)
+    if args.signature_on_source or args.signature_on_target:
+        drop_synced_pairs(index)
     what_to_do = get_sync_direction(index)
 
     if args.summary:
@@ -325,32 +758,73 @@ def main():
     t0 = time.time()
     print(F"Coping started at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))}")
 
-    workers = []
-    num_workders = 1 if args.dry_run else args.max_workers
+    removes, folder_removes = split_by_pathtype(what_to_do[Action.REMOVE_TARGET])
+    copies_s2t, folder_copies_s2t = split_by_pathtype(what_to_do[Action.COPY_SOURCE_TO_TARGET])
+    copies_t2s, folder_copies_t2s = split_by_pathtype(what_to_do[Action.COPY_TARGET_TO_SOURCE])
+
+    # Create all missing folders up front (parents first), so file copies do not need to check their destination folder.
+    # Every missing parent folder of a copied file is listed on the other side as well, i.e. it is one of these folders.
+    # Folders are created serially, parallel mkdir calls would just queue on file system metadata lock anyway.
+    folders_to_make = [(relpath, target_info.abspath) for relpath, _, target_info in folder_copies_s2t]
+    folders_to_make.extend((relpath, source_info.abspath) for relpath, source_info, _ in folder_copies_t2s)
+    for _, folderpath in sorted(folders_to_make, key=lambda item: item[0].count(os.sep)):
+        make_dir(folderpath)
+
+    # small files are copied folder by folder, files are opened relative to the opened folders
+    small_copies = []
+    if not args.dry_run and os.open in os.supports_dir_fd:
+        small_copies_s2t, copies_s2t = split_small_copies(copies_s2t, source_to_target=True)
+        small_copies_t2s, copies_t2s = split_small_copies(copies_t2s, source_to_target=False)
+        small_copies.extend((src_dir, dst_dir, names, args.signature_on_target, args.signature_on_source) for (src_dir, dst_dir), names in small_copies_s2t.items())
+        small_copies.extend((src_dir, dst_dir, names, args.signature_on_source, args.signature_on_target) for (src_dir, dst_dir), names in small_copies_t2s.items())
+
+    workers = {}
+    num_workders = 1 if args.dry_run else (args.max_workers or min(32, (os.cpu_count() or 1) + 4))
+    jobs = ((remove_target, removes), (copy_source_to_target, copies_s2t), (copy_target_to_source, copies_t2s))
+    n_all = sum(len(tasks) for _, tasks in jobs) + sum(len(names) for _, _, names, _, _ in small_copies)
+
+    # keep at least a few batches per worker so big files do not end up queued behind each other in one batch
+    batch_size = max(1, min(MAX_BATCH_SIZE, n_all // (num_workders * 4)))
     with ThreadPoolExecutor(num_workders) as pool:
-        for data in sorted(what_to_do.values(), key=lambda tup: tup[0]):
-            workers.append(pool.submit(execute_action, data))
-
-        n_all = len(workers)
-        finished = False
-        while not finished:
-            n_finished = sum([fut.done() for fut in workers])
-            finished = (n_finished == n_all)
+        for func, tasks in jobs:
+            for i in range(0, len(tasks), batch_size):
+                batch = tasks[i:i + batch_size]
+                workers[pool.submit(execute_batch, func, batch)] = len(batch)
+        for src_dir, dst_dir, names, signature_on_dst, signature_on_src in small_copies:
+            for i in range(0, len(names), MAX_BATCH_SIZE):
+                batch = names[i:i + MAX_BATCH_SIZE]
+                workers[pool.submit(copy_small_files, src_dir, dst_dir, batch, signature_on_dst, signature_on_src)] = len(batch)
+
+        n_finished = 0
+        sys.stdout.write(F"\r\rWork in progress, finished {n_finished}/{n_all}")
+        sys.stdout.flush()
+        for fut in as_completed(workers):
+            n_finished += workers[fut]
             sys.stdout.write(F"\r\rWork in progress, finished {n_finished}/{n_all}")
             sys.stdout.flush()
-            time.sleep(0.5)
 
-        results = [fut.result() for fut in workers]
+        # errors are raised after the orphan folders are removed, so one failing file does not block that
+        errors = [fut.exception() for fut in workers if fut.exception() is not None]
 
-    if all(results):
-        print()
-        print(F"Done at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))}")
-        print(F"Total time elapsed: {time.time() - t0} sec")
+    # Remove orphan folders once all files are processed, deepest first.
+    # Folders inside another removed folder are skipped since rmtree of the parent removes them anyway.
+    removed_folders = set()
+    top_folder_removes = []
+    for relpath, _, target_info in sorted(folder_removes, key=lambda task: task[0].count(os.sep)):
+        if os.path.dirname(relpath) not in removed_folders:
+            top_folder_removes.append((relpath, target_info.abspath))
+        removed_folders.add(relpath)
+    for _, folderpath in sorted(top_folder_removes, key=lambda item: item[0].count(os.sep), reverse=True):
+        remove_dir(folderpath)
 
+    print()
+    if errors:
+        raise errors[0]
+    print(F"Done at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))}")
+    print(F"Total time elapsed: {time.time() - t0} sec")
 
-if __name__ == '__main__':
-    shutil.copyfileobj = _copyfileobj_patched       # custom copy function since Windows don't like small cache for big files to copy
 
+if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description="Simple file sync script is rsync-like tool written in Python. "
                                                      "It can do simple both-ways sync between source and target file tress. "
                                                      "Files are compares just based on their file size and last modification date. "
@@ -369,10 +843,15 @@ if __name__ == '__main__':
     arg_parser.add_argument('--summary', action="store_true", help="Print summary table with files to be changed. "
                                                                    " is recommended to be used together with '--dry-run' to find out first, what will be done.")
     arg_parser.add_argument('--dry-run', action="store_true", help="Do not copy / remove anything, just simulate actions.")
+    arg_parser.add_argument('--fast-stat', action="store_true", help="Linux only. Allow network file systems (NFS, SMB, ...) to return cached file attributes "
+                                                                     "instead of asking the server (statx with AT_STATX_DONT_SYNC). Listing is much faster, "
+                                                                     "but last modification times may be up to attribute cache timeout old.")
     arg_parser.add_argument('--max-workers', type=int, default=None, help="Number of parallel copy jobs (threads). As default min(32, os.cpu_count() + 4) is used.")
     args = arg_parser.parse_args()
-    args.exclude_folder_names = tuple(args.exclude_folder_names)
+    args.exclude_folder_names = frozenset(args.exclude_folder_names)
     args.exclude_file_ext = tuple([ext.lower() for ext in args.exclude_file_ext])
+    # one case insensitive regex matching all excluded extensions at the end of file name
+    args.exclude_file_ext_re = re.compile(r"(?i)(?:" + "|".join(map(re.escape, args.exclude_file_ext)) + r")\Z") if args.exclude_file_ext else None
 
     args.source = os.path.abspath(args.source)
     args.target = os.path.abspath(args.target)
@@ -384,5 +863,11 @@ if __name__ == '__main__':
     if not args.one_direction_sync and args.delete_orphans:
         raise Exception("Flag --delete-orphans can be used only in combination with --one-direction-sync!")
 
+    # on Linux network drives file size and modification time are loaded by statx() with narrow mask
+    args.use_statx = _get_libc_statx() is not None
+    if args.fast_stat and not args.use_statx:
+        print("Flag --fast-stat is not supported on this platform, regular stat is used.")
+        args.fast_stat = False
+
     colorama.init()
     main()